@@ -6,6 +6,7 @@ from src.version import __version__
 import sys
 import tempfile
 import os
+from operator import itemgetter
 
 def parse_args():
     trf_args_meta = ('Match', 'Mismatch', 'Delta', 'PM', 'PI', 'Minscore', 'MaxPeriod')
@@ -90,6 +91,8 @@ def main():
         tre_finder.min_cluster_size = args.min_cluster_size
         variants = tre_finder.genotype(args.loci)
 
+    variants = sorted(variants, key=itemgetter(0, 1, 2))
+
     # output both bed and tsv
     tre_finder.output_bed(variants, '{}.bed'.format(args.out_prefix))
     tre_finder.output_vcf(variants, '{}.vcf'.format(args.out_prefix), args.sample, args.loci)
@@ -5,7 +5,6 @@ import os
 from .utils import create_tmp_file, parallel_process, combine_batch_results, reverse_complement, split_tasks
 from collections import defaultdict
 import re
-import random
 import numpy as np
 
 class INS:
@@ -81,8 +80,7 @@ class INSFinder:
         all_ins = []
         if regions:
             if self.nprocs > 1:
-                random.shuffle(regions)
-                batches = list(split_tasks(regions, self.nprocs))
+                batches = split_tasks(regions, self.nprocs, shuffle=True)
                 batched_results = parallel_process(self.examine_regions, batches, self.nprocs)
                 all_ins = combine_batch_results(batched_results, type(batched_results[0]))
             else:
@@ -114,8 +112,10 @@ class INSFinder:
     def cleanup(self):
         if self.tmp_files:
             for ff in self.tmp_files:
-                if os.path.exists(ff):
+                try:
                     os.remove(ff)
+                except FileNotFoundError:
+                    pass
 
     def has_secondary_alignment(self, aln):
         try:
@@ -199,7 +199,8 @@ class INSFinder:
         clipped_pairs = defaultdict(dict)
         read_spans = {}
         for aln in bam.fetch(region[0], int(region[1]), int(region[2])):
-            if not reads_fasta and not aln.query_sequence:
+            # query_length is 0 for records without sequence, no need to decode the read
+            if not reads_fasta and not aln.query_length:
                 continue
 
             if not aln.query_name in read_spans:
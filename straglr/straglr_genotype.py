@@ -3,6 +3,7 @@ import argparse
 import sys
 import tempfile
 import os
+from operator import itemgetter
 
 from straglr.ins import INSFinder
 from straglr.tre import TREFinder
@@ -73,6 +74,9 @@ def main():
     tre_finder.min_cluster_size = args.min_cluster_size
     variants = tre_finder.genotype(args.loci)
 
+    # writers report variants in the given order, sort them once for all outputs
+    variants = sorted(variants, key=itemgetter(0, 1, 2))
+
     # output both bed and tsv
     #tre_finder.output_bed(variants, '{}.bed'.format(args.out_prefix))
     tre_finder.output_vcf(variants, args.vcf, args.sample, args.loci)
@@ -3,16 +3,18 @@ from distutils import spawn
 import sys
 import subprocess
 import os
+import tempfile
 import re
 from .variant import Variant, Allele
 from collections import defaultdict, Counter
 from operator import itemgetter, attrgetter
 import itertools
-from .utils import split_tasks, parallel_process, combine_batch_results, create_tmp_file, reverse_complement, merge_spans, complement_spans
+from array import array
+from bisect import bisect_left, bisect_right
+import numpy as np
+from .utils import split_tasks, parallel_process, combine_batch_results, create_tmp_file, reverse_complement, rotation_covers, covered_fraction, motif_regex
 from .ins import INSFinder, INS
 import math
-import random
-from pybedtools import BedTool
 from datetime import datetime
 
 class TREFinder:
@@ -28,6 +30,9 @@ class TREFinder:
             sys.exit('ABORT: {}'.format("can't find trf in PATH"))
 
         self.trf_args = trf_args
+        # trf names its output after the input file and the numeric arguments
+        m = re.search(r'(\d[\d\s]*\d)', self.trf_args)
+        self.trf_output_suffix = '.{}.dat'.format(m.group(1).replace(' ', '.')) if m is not None else None
         self.flank_len = 2000
 
         self.reads_fasta = reads_fasta
@@ -62,46 +67,59 @@ class TREFinder:
         self.remove_tmps = True if not self.debug else False
 
     def construct_trf_output(self, input_fasta):
-        m = re.search('(\d[\d\s]*\d)', self.trf_args)
-        if m is not None:
-            return '{}/{}.{}.dat'.format(os.getcwd(), os.path.basename(input_fasta), m.group(1).replace(' ', '.'))
+        if self.trf_output_suffix is not None:
+            return '{}/{}{}'.format(os.getcwd(), os.path.basename(input_fasta), self.trf_output_suffix)
+
+    def run_cmd(self, cmd):
+        """ runs external tool without a shell, stdout and stderr redirected to devnull, returns exit status """
+        try:
+            return subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode
+        except OSError:
+            sys.exit('cannot run {}'.format(' '.join(cmd)))
 
     def run_trf(self, input_fasta):
-        cmd = ' '.join(['trf', input_fasta, self.trf_args])
-        # redirect stdout and stderr to devnull
-        FNULL = open(os.devnull, 'w')
-        returncode = subprocess.call(cmd, shell=True, stdout=FNULL, stderr=FNULL)
+        cmd = ['trf', input_fasta] + self.trf_args.split()
+        self.run_cmd(cmd)
 
         output = self.construct_trf_output(input_fasta)
         if os.path.exists(output):
             return output
         else:
-            sys.exit('cannot run {}'.format(cmd))
+            sys.exit('cannot run {}'.format(' '.join(cmd)))
 
     def type_trf_cols(self, cols):
-        return list(map(int, cols[:3])) + [float(cols[3])] + list(map(int, cols[4:12])) + [float(cols[12])] + cols[13:]
+        start, end, period, copy_number, consensus_size, pmatch, pindel, score, a, c, g, t, entropy, pattern, repeat = cols
+        return [int(start), int(end), int(period), float(copy_number), int(consensus_size), int(pmatch), int(pindel),
+                int(score), int(a), int(c), int(g), int(t), float(entropy), pattern, repeat,
+                len(pattern), len(set(pattern))]
 
     def parse_trf(self, trf_output):
         """
             columns:
             start_index, end_index, periold_size, copy_number, consensus_size,
             percent_matches, percent_index, score, A, C, G, T, entropy,
-            consensus_pattern
+            consensus_pattern, repeat_sequence,
+            consensus_pattern length, number of distinct bases in consensus_pattern
 
             start and end index are 1-based
         """
         self.tmp_files.add(trf_output)
         results = defaultdict(list)
+        min_str_len, max_str_len = self.min_str_len, self.max_str_len
+        type_trf_cols = self.type_trf_cols
         with open(trf_output, 'r') as ff:
             for line in ff:
-                cols = line.rstrip().split()
+                cols = line.split()
                 if not cols:
                     continue
                 if cols[0] == 'Sequence:':
                     seq = cols[1]
-                elif len(cols) == 15:
-                    if len(cols[13]) >= self.min_str_len and len(cols[13]) <= self.max_str_len:
-                        results[seq].append(self.type_trf_cols(cols))
+                    # bound on first kept row, so sequences without hits get no entry
+                    append = None
+                elif len(cols) == 15 and min_str_len <= len(cols[13]) <= max_str_len:
+                    if append is None:
+                        append = results[seq].append
+                    append(type_trf_cols(cols))
 
         return results
 
@@ -109,16 +127,16 @@ class TREFinder:
         genome_fasta = pysam.Fastafile(self.genome_fasta)
 
         # prepare input for trf
-        trf_input = ''
+        trf_input = []
         for ins in ins_list:
             target_start, target_end = ins[1] - target_flank + 1, ins[1] + target_flank
             prefix = '.'.join(map(str, [INS.eid(ins), len(ins[5]), target_start, target_end]))
-            trf_input += '>{}.q\n{}\n'.format(prefix, ins[7])
-            trf_input += '>{}.t\n{}\n'.format(prefix, self.extract_genome_neighbour(ins[0],
-                                                                                    ins[1],
-                                                                                    target_flank,
-                                                                                    genome_fasta))
-            trf_input += '>{}.i\n{}\n'.format(prefix, ins[5])
+            trf_input.append('>{}.q\n{}\n'.format(prefix, ins[7]))
+            trf_input.append('>{}.t\n{}\n'.format(prefix, self.extract_genome_neighbour(ins[0],
+                                                                                        ins[1],
+                                                                                        target_flank,
+                                                                                        genome_fasta)))
+            trf_input.append('>{}.i\n{}\n'.format(prefix, ins[5]))
 
         results = self.perform_trf(trf_input)
 
@@ -142,14 +160,27 @@ class TREFinder:
     def analyze_trf(self, results, target_flank, full_cov=0.7):
         same_pats = self.find_similar_long_patterns_ins(results)
 
+        # motifs recur across insertions, so remember pairwise comparisons for the whole batch,
+        # the cache is only valid for this same_pats table
+        same_repeat_cache = {}
+        def same_repeat(reps, use_same_pats=True, min_fraction=0.5):
+            key = (reps, use_same_pats, min_fraction)
+            if key not in same_repeat_cache:
+                same_repeat_cache[key] = self.is_same_repeat(reps, same_pats if use_same_pats else None, min_fraction=min_fraction)
+            return same_repeat_cache[key]
+
+        # insertions are already spread over nprocs workers by examine_ins (extract_tres runs per batch),
+        # and pool workers cannot start pools of their own, so a batch is analyzed serially
         expansions = {}
         for seq_id in sorted(results.keys()):
-            eid, ins_len, gstart, gend = seq_id.rsplit('.', 3)
+            seq_results = results[seq_id]
+            if not 't' in seq_results:
+                continue
 
-            if 't' in results[seq_id]:
-                pat, pgstart, pgend = self.analyze_trf_per_seq(results[seq_id], int(ins_len), int(gstart), int(gend), same_pats, target_flank, full_cov=full_cov, seq_id=seq_id)
-                if pat is not None:
-                    expansions[eid] = pat, pgstart, pgend
+            eid, ins_len, gstart, gend = seq_id.rsplit('.', 3)
+            pat, pgstart, pgend = self.analyze_trf_per_seq(seq_results, int(ins_len), int(gstart), int(gend), same_pats, target_flank, full_cov=full_cov, seq_id=seq_id, same_repeat=same_repeat)
+            if pat is not None:
+                expansions[eid] = pat, pgstart, pgend
 
         return expansions
 
@@ -159,7 +190,7 @@ class TREFinder:
         for seq_id in results.keys():
             for seq_type in results[seq_id].keys():
                 for result in results[seq_id][seq_type]:
-                    if len(result[13]) >= min_len:
+                    if result[15] >= min_len:
                         if seq_type == 'i':
                             queries.add(result[13])
                         else:
@@ -180,12 +211,12 @@ class TREFinder:
                     return True
 
                 for rep in same_pats[rep1]:
-                    if rep2 in rep:
-                        if float(rep.count(rep2) * len(rep2)) / len(rep) >= min_fraction:
-                            return True
-                    elif rep in rep2:
-                        if float(rep2.count(rep) * len(rep)) / len(rep2) >= min_fraction:
-                            return True
+                    if len(rep2) <= len(rep):
+                        fraction = covered_fraction(rep, rep2)
+                    else:
+                        fraction = covered_fraction(rep2, rep)
+                    if fraction and fraction >= min_fraction:
+                        return True
 
             return False
 
@@ -197,15 +228,8 @@ class TREFinder:
         if rep1 == rep2:
             return True
 
-        perms1 = []
-        for i in range(len(rep1)):
-            pat = rep1[i:] + rep1[:i]
-            perms1.append(pat)
-
-        for p1 in perms1:
-            if p1 in rep2:
-                if float(rep2.count(p1) * len(p1)) / len(rep2) >= min_fraction:
-                    return True
+        if rotation_covers(rep1, rep2, min_fraction):
+            return True
 
         if same_pats:
             if check_same_pats(reps[0], reps[1]) or check_same_pats(reps[1], reps[0]):
@@ -224,24 +248,26 @@ class TREFinder:
         return False
 
     def combine_trf_coords(self, coords, bounds, buf=20, max_sep=50):
+        coords = np.array(coords, dtype=np.int64).reshape(-1, 2)
         # screen out repeat completely in the flanks
-        coords = [c for c in coords if not (c[1] < bounds[0] - buf or c[0] > bounds[1] + buf)]
-        if not coords:
+        coords = coords[(coords[:, 1] >= bounds[0] - buf) & (coords[:, 0] <= bounds[1] + buf)]
+        if not len(coords):
             return []
 
-        merged_list = merge_spans(coords)
-        gap_list = complement_spans(merged_list)
+        # merge overlapping spans and spans separated by gaps of at most max_sep
+        coords = coords[np.argsort(coords[:, 0], kind='stable')]
+        ends = np.maximum.accumulate(coords[:, 1])
+        breaks = np.flatnonzero(coords[1:, 0] - ends[:-1] - 1 > max_sep) + 1
+        starts = coords[np.concatenate(([0], breaks)), 0]
+        ends = ends[np.concatenate((breaks - 1, [len(coords) - 1]))]
 
-        gaps_filled = []
-        for i in range(len(merged_list)-1):
-            if gap_list[i]:
-                gap_size = gap_list[i][1] - gap_list[i][0] + 1
-                if gap_size <= max_sep:
-                    gaps_filled.append(gap_list[i])
+        return np.column_stack((starts, ends)).tolist()
 
-        return merge_spans(merged_list + gaps_filled)
+    def analyze_trf_per_seq(self, result, ins_len, gstart, gend, same_pats, target_flank, full_cov=0.8, mid_pt_buf=50, seq_id=None, same_repeat=None):
+        if same_repeat is None:
+            def same_repeat(reps, use_same_pats=True, min_fraction=0.5):
+                return self.is_same_repeat(reps, same_pats if use_same_pats else None, min_fraction=min_fraction)
 
-    def analyze_trf_per_seq(self, result, ins_len, gstart, gend, same_pats, target_flank, full_cov=0.8, mid_pt_buf=50, seq_id=None):
         pattern_matched = None
         pgstart, pgend = None, None
 
@@ -258,15 +284,15 @@ class TREFinder:
                 filtered_results[pt] = [r for r in result[pt] if r[0] <= mid_pts[0] and r[1] >= mid_pts[1]]
                 filtered_patterns[pt] = [r[13] for r in filtered_results[pt]]
 
-        for i_result in sorted(filtered_results['i'], key=lambda r: len(r[13])):
+        for i_result in sorted(filtered_results['i'], key=itemgetter(15)):
             i_pat = i_result[13]
-            if len(i_pat) == 1 or len(set(i_pat)) == 1:
+            if i_result[16] == 1:
                 continue
             i_pat_matches = {'q': False, 't': False}
             for pt in ('t', 'q'):
-                for r in sorted(filtered_results[pt], key=lambda r: len(r[13]), reverse=True):
+                for r in sorted(filtered_results[pt], key=itemgetter(15), reverse=True):
                     pat = r[13]
-                    if i_pat in pat or pat in i_pat or self.is_same_repeat((i_pat, pat), same_pats):
+                    if i_pat in pat or pat in i_pat or same_repeat((i_pat, pat)):
                         i_pat_matches[pt] = True
                         break
 
@@ -279,13 +305,13 @@ class TREFinder:
                     for i in range(len(filtered_results['t'])):
                         result = filtered_results['t'][i]
                         dist_from_mid[i] = min(abs(float(result[0]) - target_flank), abs(float(result[1]) - target_flank))
-                        rep_lens[i] = len(result[-1])
+                        rep_lens[i] = len(result[14])
 
                     rep_len = None
                     # check for identical repeats first
                     for i in range(len(filtered_results['t'])):
                         r = filtered_results['t'][i]
-                        if len(set(r[13])) > 1 and self.is_same_repeat((i_pat, r[13]), min_fraction=1):
+                        if r[16] > 1 and same_repeat((i_pat, r[13]), use_same_pats=False, min_fraction=1):
                             if rep_len is None or rep_lens[i] > rep_len:
                                pgstart, pgend = gstart + r[0] - 1, gstart + r[1] - 1
                                rep_len = rep_lens[i]
@@ -295,9 +321,9 @@ class TREFinder:
                     if pgstart is None:
                         for i in range(len(filtered_results['t'])):
                             r = filtered_results['t'][i]
-                            if len(set(r[13])) == 1:
+                            if r[16] == 1:
                                 continue
-                            if i_pat in r[13] or r[13] in i_pat or self.is_same_repeat((i_pat, r[13]), same_pats):
+                            if i_pat in r[13] or r[13] in i_pat or same_repeat((i_pat, r[13])):
                                 if rep_len is None or rep_lens[i] > rep_len:
                                     pgstart, pgend = gstart + r[0] - 1, gstart + r[1] - 1
                                     rep_len = rep_lens[i]
@@ -312,11 +338,11 @@ class TREFinder:
             if filtered_results['t']:
                 tpats = [r for r in filtered_results['t'] if int(r[0]) < target_flank and int(r[1]) > target_flank]
                 if tpats:
-                    tpats_sorted = sorted(tpats, key=lambda p:len(p[-1]), reverse=True)
+                    tpats_sorted = sorted(tpats, key=lambda p:len(p[14]), reverse=True)
                     pgstart, pgend = gstart + tpats_sorted[0][0] - 1, gstart + tpats_sorted[0][1] - 1
             if not pgstart and not pgend:
                 # just take the pattern with the longest repeat
-                candidates = sorted([r for r in filtered_results['i'] if r[13] in filtered_patterns['i']], key=lambda r:len(r[-1]), reverse=True)
+                candidates = sorted([r for r in filtered_results['i'] if r[13] in filtered_patterns['i']], key=lambda r:len(r[14]), reverse=True)
                 pattern_matched = candidates[0][13]
                 # deduce the insertion pos from gstart and gend, and use it as the repeat insertion point
                 mid = float(gstart + gend) / 2
@@ -336,40 +362,56 @@ class TREFinder:
                     ins_dict[eid][2] = expansions[eid][2]
 
     def merge_loci(self, tres, d=100):
-        bed_line = ''
-        for tre in tres:
-            for motif in tre[8].split(','):
-                bed_line += '{}\n'.format('\t'.join(map(str, [tre[0], tre[1], tre[2], motif])))
-        tres_bed = BedTool(bed_line, from_string=True)
-        tres_merged = tres_bed.sort().merge(d=d, c='4,2', o='distinct,count')
+        intervals = sorted((tre[0], int(tre[1]), int(tre[2]), motif) for tre in tres for motif in tre[8].split(','))
+
+        # same as bedtools sort | bedtools merge -d <d> -c 4,2 -o distinct,count
+        tres_merged = []
+        for chrom, start, end, motif in intervals:
+            if tres_merged and chrom == tres_merged[-1][0] and start <= tres_merged[-1][2] + d:
+                tres_merged[-1][2] = max(tres_merged[-1][2], end)
+                tres_merged[-1][3].add(motif)
+                tres_merged[-1][4] += 1
+            else:
+                tres_merged.append([chrom, start, end, set([motif]), 1])
+
+        for tre in tres_merged:
+            tre[3] = ','.join(sorted(tre[3]))
+
         if self.debug:
-            tres_merged.saveas('tres_loci.bed')
+            with open('tres_loci.bed', 'w') as out:
+                for tre in tres_merged:
+                    out.write('{}\n'.format('\t'.join(map(str, tre))))
 
         merged = []
         for tre in tres_merged:
             repeats = sorted(tre[3].split(','), key=len)
             if len(repeats[0]) < self.min_str_len:
                 continue
-            merged.append([tre[0], int(tre[1]), int(tre[2]), tre[3]])
+            merged.append(tre[:4])
 
         return merged
 
-    def extract_aln_tuple(self, aln, tcoord, search_direction, max_extend=200):
-        found = []
-        tpos = tcoord
+    def get_aligned_positions(self, aln):
+        """ reference and query positions of matched bases, both ascending """
+        pairs = aln.get_aligned_pairs(matches_only=True)
+        return array('l', (tpos for qpos, tpos in pairs)), array('l', (qpos for qpos, tpos in pairs))
+
+    def extract_aln_tuple(self, aln, tcoord, search_direction, max_extend=200, aligned_positions=None):
+        if aligned_positions is None:
+            aligned_positions = self.get_aligned_positions(aln)
+        tposs, qposs = aligned_positions
+
+        # closest matched reference position at or beyond tcoord in search direction
         if search_direction == 'left':
-            while not found and tpos >= tcoord - max_extend:
-                found = [p for p in aln.aligned_pairs if p[1] == tpos and p[0] is not None]
-                tpos -= 1
+            i = bisect_right(tposs, tcoord) - 1
+            if i >= 0 and tposs[i] >= tcoord - max_extend:
+                return qposs[i], tposs[i]
         else:
-            while not found and tpos <= tcoord + max_extend:
-                found = [p for p in aln.aligned_pairs if p[1] == tpos and p[0] is not None]
-                tpos += 1
+            i = bisect_left(tposs, tcoord)
+            if i < len(tposs) and tposs[i] <= tcoord + max_extend:
+                return qposs[i], tposs[i]
 
-        if found:
-            return found[0]
-        else:
-            return found
+        return None
 
     def extract_subseq(self, aln, target_start, target_end, reads_fasta=None, max_extend=50):
         tstart = None
@@ -377,21 +419,26 @@ class TREFinder:
         qstart = None
         qend = None
         seq = None
+        aligned_positions = None
 
         if target_start >= aln.reference_start and target_start <= aln.reference_end:
-            aln_tuple = self.extract_aln_tuple(aln, target_start, 'left', max_extend=max_extend)
+            aligned_positions = self.get_aligned_positions(aln)
+            aln_tuple = self.extract_aln_tuple(aln, target_start, 'left', max_extend=max_extend, aligned_positions=aligned_positions)
             if aln_tuple:
                 qstart, tstart = aln_tuple
 
         if target_end >= aln.reference_start and target_end <= aln.reference_end:
-            aln_tuple = self.extract_aln_tuple(aln, target_end, 'right', max_extend=max_extend)
+            if aligned_positions is None:
+                aligned_positions = self.get_aligned_positions(aln)
+            aln_tuple = self.extract_aln_tuple(aln, target_end, 'right', max_extend=max_extend, aligned_positions=aligned_positions)
             if aln_tuple:
                 qend, tend = aln_tuple
 
         if qstart is not None and qend is not None:
-            if aln.cigartuples[0][0] == 5:
-                qstart += aln.cigartuples[0][1]
-                qend += aln.cigartuples[0][1]
+            first_op, first_len = aln.cigartuples[0]
+            if first_op == 5:
+                qstart += first_len
+                qend += first_len
 
             if not reads_fasta:
                 seq = aln.query_sequence[qstart:qend]
@@ -409,32 +456,35 @@ class TREFinder:
 
     def examine_repeats(self, seq, repeat, max_sep=100, min_cov=0.8):
         """ for regex extracting, return the most common motif """
-        pat = re.compile(repeat.upper().replace('*', '[AGCT]'))
+        mstarts = (m.start() for m in motif_regex(repeat).finditer(seq))
+        rlen = len(repeat)
         pat_counts = Counter()
         coords = []
-        for m in pat.finditer(seq):
-            if not coords or m.start() - coords[-1] - 1 <= max_sep:
-                coords.extend([m.start(), m.start() + len(repeat) - 1])
-                pattern = seq[m.start():m.start() + len(repeat)]
-                pat_counts.update([pattern])
+        for mstart in mstarts:
+            # matches come in order, so nothing after a large gap can be joined
+            if coords and mstart - coords[-1] - 1 > max_sep:
+                break
+            coords.extend([mstart, mstart + rlen - 1])
+            pat_counts[seq[mstart:mstart + rlen]] += 1
         if not coords:
             return None, None, None
-        sorted_coords = sorted(coords)
-        return float(sorted_coords[-1] - sorted_coords[0] + 1) / len(seq) >= min_cov,\
-               (sorted_coords[0], sorted_coords[-1]),\
-               set([pat_counts.most_common()[0][0]])
+        return float(coords[-1] - coords[0] + 1) / len(seq) >= min_cov,\
+               (coords[0], coords[-1]),\
+               set([pat_counts.most_common(1)[0][0]])
 
     def perform_trf(self, seqs):
         trf_fasta = create_tmp_file(seqs)
+        self.tmp_files.add(trf_fasta)
+        return self.perform_trf_on_file(trf_fasta)
+
+    def perform_trf_on_file(self, trf_fasta):
         if self.debug:
             print('trf input {}'.format(trf_fasta))
-        self.tmp_files.add(trf_fasta)
         output = self.run_trf(trf_fasta)
         results = self.parse_trf(output)
         return results
 
     def find_similar_long_patterns_gt(self, results, patterns, min_len=15, word_size=4):
-        same_pats = {}
         queries = defaultdict(set)
         targets = defaultdict(set)
         for seq in results.keys():
@@ -443,27 +493,23 @@ class TREFinder:
                 continue
             locus = tuple(cols[:3])
             seq_len = int(cols[-3])
-            same_pats[locus] = None
             targets[locus] |= set([s for s in patterns[seq].split(',') if len(s) >= word_size])
             for result in results[seq]:
-                if len(result[13]) >= min_len or (seq_len - 2*self.trf_flank_size < 50 and len(patterns[seq]) >= 6 and len(result[13]) >= 0.5 * len(patterns[seq])):
+                if result[15] >= min_len or (seq_len - 2*self.trf_flank_size < 50 and len(patterns[seq]) >= 6 and result[15] >= 0.5 * len(patterns[seq])):
                     queries[locus].add(result[13])
 
-        qseqs = set()
-        tseqs = set()
-        for locus in queries.keys():
-            qseqs |= queries[locus]
-        for locus in targets.keys():
-            tseqs |= targets[locus]
+        # one blastn run for all loci, hits are assigned back to loci afterwards
+        qseqs = set().union(*queries.values())
+        tseqs = set().union(*targets.values())
 
         same_pats = defaultdict(dict)
         if qseqs and tseqs:
             blastn_out = self.align_patterns(qseqs, tseqs)
             hits = self.parse_pat_blastn(blastn_out)
             if hits:
-                for query in hits:
-                    for locus in queries.keys():
-                        if query in queries[locus]:
+                for locus, locus_queries in queries.items():
+                    for query in locus_queries:
+                        if query in hits:
                             same_pats[locus][query] = hits[query]
 
         return same_pats
@@ -476,35 +522,33 @@ class TREFinder:
         self.tmp_files.add(target_file)
         self.tmp_files.add(blastn_out)
 
-        cmd = ' '.join(['blastn',
-                        '-query',
-                        query_file,
-                        '-subject',
-                        target_file,
-                        '-task blastn -word_size {} -evalue 1e-10 -outfmt 6 -out'.format(word_size),
-                        blastn_out])
-        # redirect stdout and stderr to devnull
-        FNULL = open(os.devnull, 'w')
-        returncode = subprocess.call(cmd, shell=True, stdout=FNULL, stderr=FNULL)
-
-        if os.path.exists(blastn_out):
-            return blastn_out
-        else:
-            sys.exit('cannot run {}'.format(cmd))
+        cmd = ['blastn',
+               '-query', query_file,
+               '-subject', target_file,
+               '-task', 'blastn',
+               '-word_size', str(word_size),
+               '-evalue', '1e-10',
+               '-outfmt', '6',
+               '-out', blastn_out]
+        # blastn_out is created beforehand, so only the exit status tells a failed run
+        if self.run_cmd(cmd) != 0:
+            sys.exit('cannot run {}'.format(' '.join(cmd)))
+
+        return blastn_out
 
     def align_patterns(self, queries, targets, locus=None, word_size=4, min_word_size=4):
-        query_fa = ''
+        query_fa = []
         min_len = None
         for seq in queries:
             if min_len is None or len(seq) < min_len:
                 min_len = len(seq)
-            query_fa += '>{}\n{}\n'.format(seq, seq)
+            query_fa.append('>{}\n{}\n'.format(seq, seq))
 
-        target_fa = ''
+        target_fa = []
         for seq in targets:
             if min_len is None or len(seq) < min_len:
                 min_len = len(seq)
-            target_fa += '>{}\n{}\n'.format(seq, seq*2)
+            target_fa.append('>{}\n{}\n'.format(seq, seq*2))
 
         if query_fa and target_fa:
             query_file = create_tmp_file(query_fa)
@@ -513,47 +557,42 @@ class TREFinder:
             self.tmp_files.add(query_file)
             self.tmp_files.add(target_file)
             self.tmp_files.add(blastn_out)
-            cmd = ' '.join(['blastn',
-                            '-query',
-                            query_file,
-                            '-subject',
-                            target_file,
-                            '-task blastn -word_size {} -outfmt 6 -perc_identity 80 -qcov_hsp_perc 80 -out'.format(word_size),
-                            blastn_out])
-            #print(cmd)
-            # redirect stdout and stderr to devnull
-            FNULL = open(os.devnull, 'w')
-            returncode = subprocess.call(cmd, shell=True, stdout=FNULL, stderr=FNULL)
-
-            if os.path.exists(blastn_out):
-                return blastn_out
-            else:
-                sys.exit('cannot run {}'.format(cmd))
+            cmd = ['blastn',
+                   '-query', query_file,
+                   '-subject', target_file,
+                   '-task', 'blastn',
+                   '-word_size', str(word_size),
+                   '-outfmt', '6',
+                   '-perc_identity', '80',
+                   '-qcov_hsp_perc', '80',
+                   '-out', blastn_out]
+            if self.run_cmd(cmd) != 0:
+                sys.exit('cannot run {}'.format(' '.join(cmd)))
+
+            return blastn_out
 
     def parse_pat_blastn(self, blastn_out, min_pid=0.8, min_alen=0.8):
         matches = defaultdict(set)
+        # blastn reports percent identity
+        min_pid *= 100
         with open(blastn_out, 'r') as ff:
             for line in ff:
-                cols = line.rstrip().split('\t')
-                query = cols[0]
-                subject = cols[1]
-                qlen = len(query)
-                slen = len(subject)
-                pid = float(cols[2])
-                alen = int(cols[3])
-
-                if pid >= min_pid and float(alen)/min(qlen, slen) >= 0.8:
+                query, subject, pid, alen = line.split('\t', 4)[:4]
+                if float(pid) >= min_pid and float(alen) / min(len(query), len(subject)) >= min_alen:
                     matches[query].add(subject)
 
         return matches
 
-    def extract_alleles_trf(self, trf_input, repeat_seqs, flank, clipped, bam, strands, patterns, reads_fasta, too_far_from_read_end=200):
-        results = self.perform_trf(trf_input)
+    def extract_alleles_trf(self, trf_fasta, repeat_seqs, flank, clipped, bam, strands, patterns, reads_fasta, too_far_from_read_end=200):
+        results = self.perform_trf_on_file(trf_fasta)
         same_pats = self.find_similar_long_patterns_gt(results, patterns)
 
         # group by locus
         alleles = defaultdict(dict)
 
+        # reads of a locus share expected motifs, so a TRF motif is checked once per locus
+        motif_matches = {}
+
         for seq in results.keys():
             cols = seq.split(':')
             if len(cols) < 7:
@@ -563,7 +602,6 @@ class TREFinder:
             locus = tuple(cols[:3])
 
             expected_pats = patterns[seq].split(',')
-            expected_pat_sizes = [len(p) for p in expected_pats]
 
             read = ':'.join(cols[3:-5])
             gstart, gend = cols[-5], cols[-4]
@@ -573,12 +611,13 @@ class TREFinder:
             pat_lens = []
             results_matched = []
             for result in results[seq]:
-                if len(set(result[13])) > 1 and len(result[13]) >= self.min_str_len and len(result[13]) <= self.max_str_len:
-                    for pat in expected_pats:
-                        if self.is_same_repeat((result[13], pat), same_pats=same_pats[locus]):
-                            results_matched.append(result)
-                            pat_lens.append((result[13], len(result[-1])))
-                            continue
+                if result[16] > 1 and result[15] >= self.min_str_len and result[15] <= self.max_str_len:
+                    key = (locus, patterns[seq], result[13])
+                    if not key in motif_matches:
+                        motif_matches[key] = any(self.is_same_repeat((result[13], pat), same_pats=same_pats[locus]) for pat in expected_pats)
+                    if motif_matches[key]:
+                        results_matched.append(result)
+                        pat_lens.append((result[13], len(result[14])))
 
             if results_matched:
                 seq_len = int(cols[-3])
@@ -606,7 +645,7 @@ class TREFinder:
                     repeat_seq = repeat_seqs[seq][coords[0]-1:coords[-1]]
                     size = coords[-1] - coords[0] + 1
                     rpos = rstart + coords[0] - 1
-                    #pats = set([r[-2] for r in results_matched])
+                    #pats = set([r[13] for r in results_matched])
                     genome_start = int(gstart) + coords[0]
                     genome_end = int(gend) - (seq_len - coords[-1])
 
@@ -641,16 +680,28 @@ class TREFinder:
         return self.alleles_to_variants(alleles)
 
     def get_read_seqs(self, headers, bam):
-        grouped_reads = defaultdict(list)
+        regions = defaultdict(list)
         for header in headers:
             chrom, start, end, read = header.split(':')[:4]
-            grouped_reads[(chrom, start, end)].append(read)
+            regions[chrom].append((int(start), int(end), read))
 
         read_seqs = {}
-        for region, reads in grouped_reads.items():
-            for aln in bam.fetch(region[0], int(region[1]), int(region[2])):
-                if aln.query_name in reads:
-                    read_seqs[aln.query_name] = aln.query_sequence
+        for chrom in regions.keys():
+            # merge overlapping loci so that each alignment is visited once
+            merged = []
+            for start, end, read in sorted(regions[chrom]):
+                if merged and start <= merged[-1][1]:
+                    merged[-1][1] = max(merged[-1][1], end)
+                    merged[-1][2].add(read)
+                else:
+                    merged.append([start, end, set([read])])
+
+            for start, end, reads in merged:
+                for aln in bam.fetch(chrom, start, end):
+                    if aln.is_secondary:
+                        continue
+                    if aln.query_name in reads:
+                        read_seqs[aln.query_name] = aln.query_sequence
 
         return read_seqs
 
@@ -695,7 +746,6 @@ class TREFinder:
             if len(alleles[locus]) < self.min_support:
                 continue
 
-            pat_counts = Counter()
             for read in alleles[locus]:
                 variant[3].append([read,
                                    alleles[locus][read][0], # rstart
@@ -707,17 +757,13 @@ class TREFinder:
                                    alleles[locus][read][5], # strand
                                    ])
 
-                # update pattern counts
-                pat_counts.update(alleles[locus][read][1])
-
+            # pattern counts
+            pat_counts = Counter(itertools.chain.from_iterable(allele[1] for allele in alleles[locus].values()))
             pat_counts_sorted = pat_counts.most_common()
-            top_pats = [pat_counts_sorted[0][0]]
-            for i in range(1, len(pat_counts_sorted)):
-                if pat_counts_sorted[i][1] == pat_counts_sorted[0][1]:
-                    top_pats.append(pat_counts_sorted[i][0])
-                else:
-                    break
-            variant[4] = (sorted(top_pats, key=len)[0])
+            top_count = pat_counts_sorted[0][1]
+            top_pats = [pat for pat, count in itertools.takewhile(lambda pc: pc[1] == top_count, pat_counts_sorted)]
+            # shortest of the most common motifs
+            variant[4] = min(top_pats, key=len)
             for allele in variant[3]:
                 allele[2] = variant[4]
                 allele[3] = round(float(allele[4]) / len(variant[4]), 1)
@@ -727,11 +773,16 @@ class TREFinder:
         return variants
 
     def extract_missed_clipped(self, aln, clipped_end, gpos, min_proportion=0.4, reads_fasta=None):
+        # cigartuples is rebuilt from the record on every access
+        cigar = aln.cigartuples
+        first_op, first_len = cigar[0]
+        last_op, last_len = cigar[-1]
+
         clipped_size = None
-        if clipped_end == 'start' and aln.cigartuples[0][0] >= 4 and aln.cigartuples[0][0] <= 5:
-            clipped_size = aln.cigartuples[0][1]
-        elif clipped_end == 'end' and aln.cigartuples[-1][0] >= 4 and aln.cigartuples[-1][0] <= 5:
-            clipped_size = aln.cigartuples[-1][1]
+        if clipped_end == 'start' and first_op >= 4 and first_op <= 5:
+            clipped_size = first_len
+        elif clipped_end == 'end' and last_op >= 4 and last_op <= 5:
+            clipped_size = last_len
 
         tpos = None
         if clipped_size is not None:
@@ -743,10 +794,11 @@ class TREFinder:
                     tpos = tup[1]
                 return None
             else:
-                qstart, qend = aln.query_alignment_end - self.trf_flank_size, aln.infer_read_length()
+                read_len = aln.infer_read_length()
+                qstart, qend = aln.query_alignment_end - self.trf_flank_size, read_len
                 tup = self.extract_aln_tuple(aln, max(aln.reference_end, gpos[1]) + self.trf_flank_size, 'right')
                 if tup:
-                    qstart, qend = tup[0], aln.infer_read_length()
+                    qstart, qend = tup[0], read_len
                     tpos = tup[1]
                 else:
                     return None
@@ -755,8 +807,8 @@ class TREFinder:
             if not reads_fasta:
                 seq = aln.query_sequence[qstart:qend]
             else:
-                if aln.cigartuples[0][0] == 5:
-                    qstart = aln.cigartuples[0][1] + qstart
+                if first_op == 5:
+                    qstart = first_len + qstart
                 seq = INSFinder.get_seq(reads_fasta, aln.query_name, aln.is_reverse, [qstart, qend])
             return qstart, qend, tpos, seq
 
@@ -776,70 +828,59 @@ class TREFinder:
         results = []
         with open(blastn_out, 'r') as ff:
             for line in ff:
-                cols = line.rstrip().split('\t')
-                query = cols[0]
-                subject = cols[1]
-                pid = float(cols[2])
-                alen = int(cols[3])
-                qstart = int(cols[6])
-                qend = int(cols[7])
-                sstart = int(cols[8])
-                send = int(cols[9])
-                evalue = float(cols[10])
-                results.append([query, subject, pid, alen, evalue, qstart, qend, sstart, send])
+                query, subject, pid, alen, mismatches, gaps, qstart, qend, sstart, send, evalue = line.split('\t', 11)[:11]
+                results.append([query, subject, float(pid), int(alen), float(evalue), int(qstart), int(qend), int(sstart), int(send)])
 
-        if results:
-            return sorted(results, key=itemgetter(4))
-        else:
-            return results
+        results.sort(key=itemgetter(4))
+        return results
 
     def rescue_missed_clipped(self, missed, genome_fasta, min_mapped=0.7, max_evalue=1e-10):
         rescued = []
-        target_fa = ''
-        query_fa = ''
+        target_fa = []
+        query_fa = []
         seqs = {}
         loci = {}
         for locus, clipped_end, read, qstart, qend, tpos, seq in missed:
-            target_fa += '>{}:{}:{}:{}:{}\n{}\n'.format(read, qstart, qend, tpos, len(seq), seq)
+            target_fa.append(f'>{read}:{qstart}:{qend}:{tpos}:{len(seq)}\n{seq}\n')
             seqs[read] = seq
             loci[read] = locus
 
             pstart, pend, pseq = self.get_probe(clipped_end, locus, genome_fasta)
-            query_fa += '>{}:{}:{}:{}:{}\n{}\n'.format(read, clipped_end, pstart, pend, len(pseq), pseq)
+            query_fa.append(f'>{read}:{clipped_end}:{pstart}:{pend}:{len(pseq)}\n{pseq}\n')
 
         blastn_out = self.run_blastn_for_missed_clipped(query_fa, target_fa, 6)
-        if os.path.exists(blastn_out):
-            results = self.parse_blastn(blastn_out)
-            if results:
-                by_read = defaultdict(list)
-                # group blastn results
-                for r in results:
-                    if list(r[0].split(':'))[0] == list(r[1].split(':'))[0]:
-                        read = list(r[0].split(':'))[0]
-                        by_read[read].append(r)
-
-                for read in sorted(by_read.keys()):
-                    # filter results
-                    rlen = int(by_read[read][0][0].split(':')[-1])
-                    filtered_results = [r for r in by_read[read] if r[3] / rlen >= min_mapped and r[4] <= max_evalue]
-                    if not filtered_results:
-                        continue
-                    best_result = filtered_results[0]
-                    read, qstart, qend, tpos, tlen = best_result[1].split(':')
-                    read, clipped_end, pstart, pend, plen = best_result[0].split(':')
-
-                    if clipped_end == 'start':
-                        qstart = int(qstart) + best_result[-2]
-                        tstart = int(pstart)
-                        tend = int(tpos)
-                        trf_seq = seqs[read][best_result[-2]:]
-                    else:
-                        qend = int(qstart) + best_result[-1]
-                        tstart = int(tpos)
-                        tend = int(pend)
-                        trf_seq = seqs[read][:best_result[-1]]
+        results = self.parse_blastn(blastn_out)
+        if results:
+            def query_read(hit):
+                return hit[0].partition(':')[0]
+
+            # keep hits between probe and clipped sequence of the same read
+            results = [r for r in results if query_read(r) == r[1].partition(':')[0]]
+            # stable sort, hits of each read stay in evalue order
+            results.sort(key=query_read)
+
+            for read, hits in itertools.groupby(results, key=query_read):
+                hits = list(hits)
+                # mapped fraction is relative to the probe length of the lowest-evalue hit
+                rlen = int(hits[0][0].rpartition(':')[2])
+                best_result = next((r for r in hits if r[3] / rlen >= min_mapped and r[4] <= max_evalue), None)
+                if best_result is None:
+                    continue
+                read, qstart, qend, tpos, tlen = best_result[1].split(':')
+                read, clipped_end, pstart, pend, plen = best_result[0].split(':')
+
+                if clipped_end == 'start':
+                    qstart = int(qstart) + best_result[-2]
+                    tstart = int(pstart)
+                    tend = int(tpos)
+                    trf_seq = seqs[read][best_result[-2]:]
+                else:
+                    qend = int(qstart) + best_result[-1]
+                    tstart = int(tpos)
+                    tend = int(pend)
+                    trf_seq = seqs[read][:best_result[-1]]
 
-                    rescued.append([read, clipped_end, qstart, qend, tstart, tend, trf_seq, loci[read]])
+                rescued.append([read, clipped_end, qstart, qend, tstart, tend, trf_seq, loci[read]])
 
         return rescued
 
@@ -850,7 +891,6 @@ class TREFinder:
                 reads_fasta.append(pysam.Fastafile(fa))
         genome_fasta = pysam.Fastafile(self.genome_fasta)
 
-        trf_input = ''
         strands = {}
         repeat_seqs = {}
         generic = set()
@@ -860,156 +900,162 @@ class TREFinder:
         min_mapped = 0.5
         all_clipped = {}
         missed_clipped = []
+        split_cache = {}
 
         if self.strict:
             self.trf_flank_size = 80
 
-        for locus in loci:
-            clipped = defaultdict(dict)
-            alns = []
-            for aln in bam.fetch(locus[0], locus[1] - split_neighbour_size, locus[2] + split_neighbour_size):
-                if not reads_fasta and not aln.query_sequence:
-                    continue
-                alns.append(aln)
-                strands[aln.query_name] = '-' if aln.is_reverse else '+'
-                locus_size = locus[2] - locus[1] + 1
-
-                # check split alignments first
-                if self.check_split_alignments and\
-                   ((aln.reference_start >= locus[1] - split_neighbour_size and aln.reference_start <= locus[2] + split_neighbour_size) or\
-                    (aln.reference_end >= locus[1] - split_neighbour_size and aln.reference_end <= locus[2] + split_neighbour_size)):
-                    check_end = None
-                    start_olap = False
-                    end_olap = False
-                    if aln.reference_start >= locus[1] - split_neighbour_size and aln.reference_start <= locus[2] + split_neighbour_size:
-                        start_olap = True
-                    if aln.reference_end >= locus[1] - split_neighbour_size and aln.reference_end <= locus[2] + split_neighbour_size:
-                        end_olap = True
-                    if start_olap and not end_olap:
-                        check_end = 'start'
-                    elif end_olap and not start_olap:
-                        check_end = 'end'
-                    clipped_end = None
-                    if check_end is not None:
-                        clipped_end, partner_start = INSFinder.is_split_aln_potential_ins(aln, min_split_size=400, closeness_to_end=10000, check_end=check_end, use_sa=True)
-                    if clipped_end is not None:
-                        clipped[aln.query_name][clipped_end] = (aln, partner_start)
-
-            # clipped alignment
-            remove = set()
-            for read in clipped.keys():
-                if len(clipped[read].keys()) == 2:
-                    aln1 = clipped[read]['end'][0]
-                    aln2 = clipped[read]['start'][0]
-                    if aln1.is_reverse != aln2.is_reverse:
+        # fasta entries are streamed to the trf input file as they are made
+        fd, trf_fasta = tempfile.mkstemp()
+        self.tmp_files.add(trf_fasta)
+        with os.fdopen(fd, 'w') as trf_input:
+            # batches are shuffled for load balancing, visiting loci in genomic order
+            # lets successive fetches reuse neighbouring BAM blocks instead of seeking back and forth
+            for locus in sorted(loci, key=itemgetter(0, 1, 2)):
+                locus_key = tuple(locus)
+                clipped = defaultdict(dict)
+                alns = []
+                split_lo, split_hi = locus[1] - split_neighbour_size, locus[2] + split_neighbour_size
+                flank_lo, flank_hi = locus[1] - self.trf_flank_size, locus[2] + self.trf_flank_size
+                single_lo, single_hi = locus[1] - single_neighbour_size, locus[2] + single_neighbour_size
+                for aln in bam.fetch(locus[0], split_lo, split_hi):
+                    if not reads_fasta and not aln.query_length:
                         continue
-                    if reads_fasta or aln1.query_alignment_end < aln2.query_alignment_start:
-                        aln1_tuple = self.extract_aln_tuple(aln1, locus[1] - self.trf_flank_size, 'left')
-                        aln2_tuple = self.extract_aln_tuple(aln2, locus[2] + self.trf_flank_size, 'right')
-                        qstart = None
-                        qend = None
-                        tstart = None
-                        tend = None
-                        if aln1_tuple and aln2_tuple:
-                            qstart, tstart = aln1_tuple
-                            qend, tend = aln2_tuple
-                            if not reads_fasta:
-                                seq = aln1.query_sequence[qstart:qend]
+                    alns.append(aln)
+                    strands[aln.query_name] = '-' if aln.is_reverse else '+'
+
+                    # check split alignments first, only alignments with exactly one end near the locus
+                    if self.check_split_alignments:
+                        rs, re_ = aln.reference_start, aln.reference_end
+                        start_olap = split_lo <= rs <= split_hi
+                        end_olap = split_lo <= re_ <= split_hi
+                        if start_olap != end_olap:
+                            check_end = 'start' if start_olap else 'end'
+                            # the same alignment is refetched for neighbouring loci, a read can have several alignments here
+                            split_key = (aln.query_name, aln.flag, rs, re_, check_end)
+                            if split_key not in split_cache:
+                                split_cache[split_key] = INSFinder.is_split_aln_potential_ins(aln, min_split_size=400, closeness_to_end=10000, check_end=check_end, use_sa=True)
+                            clipped_end, partner_start = split_cache[split_key]
+                            if clipped_end is not None:
+                                clipped[aln.query_name][clipped_end] = (aln, partner_start)
+
+                # clipped alignment
+                remove = set()
+                for read, ends in clipped.items():
+                    if len(ends) == 2:
+                        aln1 = ends['end'][0]
+                        aln2 = ends['start'][0]
+                        if aln1.is_reverse != aln2.is_reverse:
+                            continue
+                        if reads_fasta or aln1.query_alignment_end < aln2.query_alignment_start:
+                            aln1_tuple = self.extract_aln_tuple(aln1, flank_lo, 'left')
+                            aln2_tuple = self.extract_aln_tuple(aln2, flank_hi, 'right')
+                            qstart = None
+                            qend = None
+                            tstart = None
+                            tend = None
+                            if aln1_tuple and aln2_tuple:
+                                qstart, tstart = aln1_tuple
+                                qend, tend = aln2_tuple
+                                if not reads_fasta:
+                                    seq = aln1.query_sequence[qstart:qend]
+                                else:
+                                    aln1_op, aln1_len = aln1.cigartuples[0]
+                                    aln2_op, aln2_len = aln2.cigartuples[0]
+                                    if aln1_op == 5:
+                                        qstart = aln1_len + qstart
+                                    if aln2_op == 5:
+                                        qend = aln2_len + qend
+                                    seq = INSFinder.get_seq(reads_fasta, aln1.query_name, aln1.is_reverse, [qstart, qend])
+                                alns.remove(aln1)
+                                alns.remove(aln2)
+
+                                if not seq:
+                                    if self.debug:
+                                        print('problem getting seq2 {} {}'.format(aln.query_name, locus))
+                                    continue
                             else:
-                                if aln1.cigartuples[0][0] == 5:
-                                    qstart = aln1.cigartuples[0][1] + qstart
-                                if aln2.cigartuples[0][0] == 5:
-                                    qend = aln2.cigartuples[0][1] + qend
-                                seq = INSFinder.get_seq(reads_fasta, aln1.query_name, aln1.is_reverse, [qstart, qend])
-                            alns.remove(aln1)
-                            alns.remove(aln2)
-
-                            if not seq:
-                                if self.debug:
-                                    print('problem getting seq2 {} {}'.format(aln.query_name, locus))
+                                if aln1.query_alignment_length > aln2.query_alignment_length:
+                                    clipped_end = 'end'
+                                    aln = aln1
+                                else:
+                                    clipped_end = 'start'
+                                    aln = aln2
+                                missed = self.extract_missed_clipped(aln, clipped_end, locus[1:], reads_fasta=reads_fasta)
+                                if missed:
+                                    qstart, qend, tpos, seq = missed
+                                    missed_clipped.append([locus_key, clipped_end, read, qstart, qend, tpos, seq])
                                 continue
-                        else:
-                            if aln1.query_alignment_length > aln2.query_alignment_length:
-                                clipped_end = 'end'
-                                aln = aln1
+
+                            # leave patterns out, some too long for trf header
+                            header, fa_entry = self.create_trf_fasta(locus[:3], aln1.query_name, tstart, tend, qstart, seq, aln1.infer_read_length())
+                            patterns[header] = locus[-1]
+                            repeat_seqs[header] = seq
+
+                            if not '*' in locus[-1]:
+                                trf_input.write(fa_entry)
                             else:
-                                clipped_end = 'start'
-                                aln = aln2
-                            missed = self.extract_missed_clipped(aln, clipped_end, locus[1:], reads_fasta=reads_fasta)
-                            if missed:
-                                qstart, qend, tpos, seq = missed
-                                missed_clipped.append([tuple(locus), clipped_end, read, qstart, qend, tpos, seq])
+                                generic.add(header)
+                                repeat_seqs[header] = seq
+
+                        else:
+                            remove.add(read)
+                    else:
+                        clipped_end = next(iter(ends))
+                        aln = ends[clipped_end][0]
+                        missed = self.extract_missed_clipped(aln, clipped_end, locus[1:], reads_fasta=reads_fasta)
+                        if missed:
+                            qstart, qend, tpos, seq = missed
+                            missed_clipped.append([locus_key, clipped_end, read, qstart, qend, tpos, seq])
+
+                for read in remove:
+                    del clipped[read]
+
+                all_clipped[locus_key] = clipped
+
+                for aln in alns:
+                    if aln.reference_start <= single_lo and aln.reference_end >= single_hi:
+                        # don't consider alignment if it's deemed split at locus
+                        if aln.query_name in clipped:
+                            continue
+                        seq, tstart, tend, qstart = self.extract_subseq(aln, flank_lo, flank_hi, reads_fasta=reads_fasta)
+                        if seq is None:
+                            if self.debug:
+                                print('problem getting seq1 {} {} {} {} {}'.format(aln.query_name, locus, tstart, tend, qstart))
                             continue
 
                         # leave patterns out, some too long for trf header
-                        header, fa_entry = self.create_trf_fasta(locus[:3], aln1.query_name, tstart, tend, qstart, seq, aln1.infer_read_length())
-                        patterns[header] = locus[-1]
+                        header, fa_entry = self.create_trf_fasta(locus[:3], aln.query_name, tstart, tend, qstart, seq, aln.infer_read_length())
+                        patterns[header] = locus[3]
                         repeat_seqs[header] = seq
 
-                        if not '*' in locus[-1]:
-                            trf_input += fa_entry
+                        if not '*' in locus[3]:
+                            trf_input.write(fa_entry)
                         else:
                             generic.add(header)
-                            repeat_seqs[header] = seq
 
-                    else:
-                        remove.add(read)
-                else:
-                    clipped_end = list(clipped[read].keys())[0]
-                    aln = clipped[read][clipped_end][0]
-                    missed = self.extract_missed_clipped(aln, clipped_end, locus[1:], reads_fasta=reads_fasta)
-                    if missed:
-                        qstart, qend, tpos, seq = missed
-                        missed_clipped.append([tuple(locus), clipped_end, read, qstart, qend, tpos, seq])
-
-            for read in remove:
-                del clipped[read]
-
-            all_clipped[tuple(locus)] = clipped
-
-            for aln in alns:
-                if aln.reference_start <= locus[1] - single_neighbour_size and\
-                   aln.reference_end >= locus[2] + single_neighbour_size:
-                    # don't consider alignment if it's deemed split at locus
-                    if aln.query_name in clipped:
+            if missed_clipped:
+                rescued = self.rescue_missed_clipped(missed_clipped, genome_fasta)
+                for read, clipped_end, qstart, qend, tstart, tend, seq, locus in rescued:
+                    clipped = all_clipped[locus]
+                    aln = next(iter(clipped[read].values()))[0]
+                    # skip split alignment if start or end too close to repeat (with 50bp)
+                    if not(aln.reference_start + closeness_to_end) <= locus[1] and not (aln.reference_end - closeness_to_end >= locus[2]):
                         continue
-                    seq, tstart, tend, qstart = self.extract_subseq(aln, locus[1] - self.trf_flank_size, locus[2] + self.trf_flank_size, reads_fasta=reads_fasta)
-                    if seq is None:
-                        if self.debug:
-                            print('problem getting seq1 {} {} {} {} {}'.format(aln.query_name, locus, tstart, tend, qstart))
-                        continue
-
-                    # leave patterns out, some too long for trf header
-                    header, fa_entry = self.create_trf_fasta(locus[:3], aln.query_name, tstart, tend, qstart, seq, aln.infer_read_length())
-                    patterns[header] = locus[3]
+                    header, fa_entry = self.create_trf_fasta(locus[:3], read, tstart, tend, qstart, seq, aln.infer_read_length())
+                    patterns[header] = locus[-3]
                     repeat_seqs[header] = seq
 
                     if not '*' in locus[3]:
-                        trf_input += fa_entry
+                        trf_input.write(fa_entry)
                     else:
                         generic.add(header)
 
-        if missed_clipped:
-            rescued = self.rescue_missed_clipped(missed_clipped, genome_fasta)
-            for read, clipped_end, qstart, qend, tstart, tend, seq, locus in rescued:
-                clipped = all_clipped[locus]
-                aln = clipped[read][list(clipped[read].keys())[0]][0]
-                # skip split alignment if start or end too close to repeat (with 50bp)
-                if not(aln.reference_start + closeness_to_end) <= locus[1] and not (aln.reference_end - closeness_to_end >= locus[2]):
-                    continue
-                header, fa_entry = self.create_trf_fasta(locus[:3], read, tstart, tend, qstart, seq, aln.infer_read_length())
-                patterns[header] = locus[-3]
-                repeat_seqs[header] = seq
-
-                if not '*' in locus[3]:
-                    trf_input += fa_entry
-                else:
-                    generic.add(header)
-
+            has_trf_input = trf_input.tell() > 0
 
         variants = []
-        if trf_input:
-            variants.extend(self.extract_alleles_trf(trf_input,
+        if has_trf_input:
+            variants.extend(self.extract_alleles_trf(trf_fasta,
                                                      repeat_seqs,
                                                      self.trf_flank_size,
                                                      clipped,
@@ -1041,30 +1087,33 @@ class TREFinder:
 
         return variants
 
-    def examine_ins(self, ins_list, min_expansion=0):
-        def filter_tres(ins_list, tre_events):
-            for ins in ins_list:
-                if ins[6] == 'tre':
-                    motifs = [m for m in ins[-1].split(',') if len(m) >= self.min_str_len and len(m) <= self.max_str_len]
-                    if motifs:
-                        ins[-1] = ','.join(set(motifs))
-                        tre_events.append(ins)
+    def filter_tres(self, ins_list):
+        tre_events = []
+        for ins in ins_list:
+            if ins[6] == 'tre':
+                motifs = [m for m in ins[-1].split(',') if len(m) >= self.min_str_len and len(m) <= self.max_str_len]
+                if motifs:
+                    ins[-1] = ','.join(set(motifs))
+                    tre_events.append(ins)
+
+        return tre_events
 
+    def extract_tre_events(self, ins_list):
+        """ finds, labels and filters the repeat expansions of a batch of insertions """
+        expansions = self.extract_tres(ins_list)
+        self.annotate(ins_list, expansions)
+        return self.filter_tres(ins_list)
+
+    def examine_ins(self, ins_list, min_expansion=0):
+        # labelling and filtering run in the workers too, only the tre events come back
         if self.nprocs > 1:
-            random.shuffle(ins_list)
-            batches = list(split_tasks(ins_list, self.nprocs))
+            batches = split_tasks(ins_list, self.nprocs, shuffle=True)
             if not batches:
                 return []
-            batched_results = parallel_process(self.extract_tres, batches, self.nprocs)
-            expansions = combine_batch_results(batched_results, type(batched_results[0]))
+            batched_results = parallel_process(self.extract_tre_events, batches, self.nprocs)
+            tre_events = combine_batch_results(batched_results, list)
         else:
-            expansions = self.extract_tres(ins_list)
-
-        # label ins
-        self.annotate(ins_list, expansions)
-
-        tre_events = []
-        filter_tres(ins_list, tre_events)
+            tre_events = self.extract_tre_events(ins_list)
 
         if tre_events:
             merged_loci = self.merge_loci(tre_events)
@@ -1083,25 +1132,21 @@ class TREFinder:
         return []
 
     def remove_redundants(self, variants):
-        groups = defaultdict(list)
-        for i in range(len(variants)):
-            variant = variants[i]
-            key = '-'.join(map(str, [variant[0], variant[1], variant[2]]))
-            groups[key].append(i)
-
-        remove = []
-        for key in groups.keys():
-            if len(groups[key]) > 1:
-                remove.extend(sorted(groups[key])[1:])
+        # keep the first variant reported for each locus, in place
+        seen = set()
+        kept = []
+        for variant in variants:
+            key = tuple(map(str, variant[:3]))
+            if not key in seen:
+                seen.add(key)
+                kept.append(variant)
 
-        for i in sorted(remove, reverse=True):
-            del variants[i]
+        variants[:] = kept
 
     def collect_alleles(self, loci):
         tre_variants = []
         if self.nprocs > 1:
-            random.shuffle(loci)
-            batches = list(split_tasks(loci, self.nprocs))
+            batches = split_tasks(loci, self.nprocs, shuffle=True)
             batched_results = parallel_process(self.get_alleles, batches, self.nprocs)
             tre_variants = combine_batch_results(batched_results, type(batched_results[0]))
         else:
@@ -1133,17 +1178,34 @@ class TREFinder:
         return self.collect_alleles(loci)
 
     def output_tsv(self, variants, out_file, cmd=None):
+        rows = []
+        if cmd is not None:
+            rows.append('#{} {}\n'.format(datetime.now().strftime("%Y-%m-%d_%H:%M:%S"), cmd))
+        rows.append('#{}\n'.format('\t'.join(Variant.tsv_headers + Allele.tsv_headers)))
+        for variant in variants:
+            if not variant[5]:
+                continue
+            variant_cols = Variant.to_tsv(variant)
+            for allele in sorted(variant[3], key=itemgetter(3), reverse=True):
+                allele_cols = Allele.to_tsv(allele)
+                rows.append('{}\n'.format('\t'.join(variant_cols + allele_cols)))
+
         with open(out_file, 'w') as out:
-            if cmd is not None:
-                out.write('#{} {}\n'.format(datetime.now().strftime("%Y-%m-%d_%H:%M:%S"), cmd))
-            out.write('#{}\n'.format('\t'.join(Variant.tsv_headers + Allele.tsv_headers)))
-            for variant in sorted(variants, key=itemgetter(0, 1, 2)):
-                if not variant[5]:
-                    continue
-                variant_cols = Variant.to_tsv(variant)
-                for allele in sorted(variant[3], key=itemgetter(3), reverse=True):
-                    allele_cols = Allele.to_tsv(allele)
-                    out.write('{}\n'.format('\t'.join(variant_cols + allele_cols)))
+            out.writelines(rows)
+
+    def get_allele_sizes(self, motif, gt):
+        """ (size, copy number, support) of each numeric allele in genotype gt """
+        motif_len = len(motif)
+        allele_sizes = []
+        for allele, support in gt:
+            if type(allele) is str:
+                continue
+            if self.genotype_in_size:
+                allele_sizes.append((allele, round(allele / motif_len, 1), support))
+            else:
+                allele_sizes.append((allele * motif_len, allele, support))
+
+        return allele_sizes
 
     def output_bed(self, variants, out_file):
         headers = Variant.bed_headers
@@ -1152,35 +1214,22 @@ class TREFinder:
             for j in ('size', 'copy_number', 'support'):
                 headers.append('allele{}:{}'.format(i+1, j))
 
-        with open(out_file, 'w') as out:
-            out.write('#{}\n'.format('\t'.join(headers)))
-            for variant in sorted(variants, key=itemgetter(0, 1, 2)):
-                cols = variant[:3] + [variant[4]]
-                sizes = []
-                copy_numbers = []
-                supports = []
-
-                gt = Variant.get_genotype(variant)
-                for allele, support in gt:
-                    if type(allele) is str:
-                        continue
-                    supports.append(support)
-                    if self.genotype_in_size:
-                        sizes.append(allele)
-                        copy_numbers.append(round(allele / len(variant[4]) , 1))
-                    else:
-                        copy_numbers.append(allele)
-                        sizes.append(allele * len(variant[4]))
+        rows = ['#{}\n'.format('\t'.join(headers))]
+        for variant in variants:
+            cols = variant[:3] + [variant[4]]
 
-                for size, copy_number, support in zip(sizes, copy_numbers, supports):
-                    cols.extend([size, copy_number, support])
+            gt = Variant.get_genotype(variant)
+            for allele_size in self.get_allele_sizes(variant[4], gt):
+                cols.extend(allele_size)
 
-                if len(gt) < self.max_num_clusters:
-                    for i in range(self.max_num_clusters - len(gt)):
-                        cols.extend(['-'] * 3)
+            if len(gt) < self.max_num_clusters:
+                for i in range(self.max_num_clusters - len(gt)):
+                    cols.extend(['-'] * 3)
 
-                out.write('{}\n'.format('\t'.join(map(str, cols))))
+            rows.append('{}\n'.format('\t'.join(map(str, cols))))
 
+        with open(out_file, 'w') as out:
+            out.writelines(rows)
 
     def output_vcf(self, variants, out_file, sample, loci_bed):
 
@@ -1198,87 +1247,89 @@ class TREFinder:
         VCF_headers = ["CHROM", "POS", "ID", "REF", "ALT", "QUAL", "FILTER", "INFO", "FORMAT"] + [sample]
         headers = VCF_headers
 
-        with open(out_file, 'w') as out:
-            out.write('##fileformat=VCFv4.1\n')
-            out.write('##INFO=<ID=END,Number=1,Type=Integer,Description="End position of the variant">\n')
-            out.write('##INFO=<ID=REF,Number=1,Type=Integer,Description="Reference copy number">\n')
-            out.write('##INFO=<ID=REPID,Number=1,Type=String,Description="Repeat identifier as specified in the variant catalog">\n')
-            out.write('##INFO=<ID=VARID,Number=1,Type=String,Description="Variant identifier as specified in the variant catalog">\n')
-            out.write('##INFO=<ID=RL,Number=1,Type=Integer,Description="Reference length in bp">\n')
-            out.write('##INFO=<ID=RU,Number=1,Type=String,Description="Repeat unit in the reference orientation">\n')
-            out.write('##INFO=<ID=SVTYPE,Number=1,Type=String,Description="Type of structural variant">\n')
-            out.write('##FILTER=<ID=LowDepth,Description="The overall locus depth is below 10x or number of reads spanning one or both breakends is below 5">\n')
-            out.write('##FILTER=<ID=PASS,Description="All filters passed">\n')
-            out.write('##FORMAT=<ID=AD,Number=.,Type=Integer,Description="Allelic depths for the ref and alt alleles in the order listed">\n')
-            out.write('##FORMAT=<ID=ADFL,Number=1,Type=String,Description="Number of flanking reads consistent with the allele">\n')
-            out.write('##FORMAT=<ID=ADIR,Number=1,Type=String,Description="Number of in-repeat reads consistent with the allele">\n')
-            out.write('##FORMAT=<ID=ADSP,Number=1,Type=String,Description="Number of spanning reads consistent with the allele">\n')
-            out.write('##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n')
-            out.write('##FORMAT=<ID=LC,Number=1,Type=Float,Description="Locus coverage">\n')
-            out.write('##FORMAT=<ID=REPCI,Number=1,Type=String,Description="Confidence interval for REPCN">\n')
-            out.write('##FORMAT=<ID=REPCN,Number=1,Type=String,Description="Number of repeat units spanned by the allele">\n')
-            out.write('##FORMAT=<ID=SO,Number=1,Type=String,Description="Type of reads that support the allele; can be SPANNING, FLANKING, or INREPEAT meaning that the reads span, flank, or are fully contained in the repeat">\n')
-            out.write('##ALT=<ID=STR10,Description="Allele comprised of 10 repeat units">\n')
-            out.write('##ALT=<ID=STR2,Description="Allele comprised of 2 repeat units">\n')
-            out.write('#{}\n'.format('\t'.join(headers)))
-            for variant in sorted(variants, key=itemgetter(0, 1, 2)):
-                cols = variant[:3] + [variant[4]]
-                sizes = []
-                copy_numbers = []
-                supports = []
-                ci = {}
-                for l, m, u in variant[5]:
-                    ci[m] = (l, u)
-                #print(variant[5])
-                gt = Variant.get_genotype(variant)
-
-                for allele, support in gt:
-                    if type(allele) is str:
-                        continue
-                    supports.append(support)
-                    if self.genotype_in_size:
-                        sizes.append(allele)
-                        copy_numbers.append(round(allele / len(variant[4]) , 1))
-                    else:
-                        copy_numbers.append(allele)
-                        sizes.append(allele * len(variant[4]))
-
-                for size, copy_number, support in zip(sizes, copy_numbers, supports):
-                    cols.extend([size, copy_number, support])
-
-                chrom = cols[0]
-                start_pos = cols[1]
-                end_pos = cols[2]
-
-                ref_repeat_length = int(end_pos) - int(start_pos)
-                repeat_unit = cols[3]
-                ref_allele = repeat_unit[0]
-                ref_repeat_count = int(ref_repeat_length / len(repeat_unit))
-                repeat_id, variant_id = loci["{}:{}-{}".format(chrom, start_pos, end_pos)]
-
-                allele1_repeat_count = round(cols[5])
-                allel1_ci_lower, allel1_ci_upper = ci[cols[5]]
-                allel1_support = cols[6]
-
-                homzygous =  len(gt) == 1
+        rows = [
+            '##fileformat=VCFv4.1\n',
+            '##INFO=<ID=END,Number=1,Type=Integer,Description="End position of the variant">\n',
+            '##INFO=<ID=REF,Number=1,Type=Integer,Description="Reference copy number">\n',
+            '##INFO=<ID=REPID,Number=1,Type=String,Description="Repeat identifier as specified in the variant catalog">\n',
+            '##INFO=<ID=VARID,Number=1,Type=String,Description="Variant identifier as specified in the variant catalog">\n',
+            '##INFO=<ID=RL,Number=1,Type=Integer,Description="Reference length in bp">\n',
+            '##INFO=<ID=RU,Number=1,Type=String,Description="Repeat unit in the reference orientation">\n',
+            '##INFO=<ID=SVTYPE,Number=1,Type=String,Description="Type of structural variant">\n',
+            '##FILTER=<ID=LowDepth,Description="The overall locus depth is below 10x or number of reads spanning one or both breakends is below 5">\n',
+            '##FILTER=<ID=PASS,Description="All filters passed">\n',
+            '##FORMAT=<ID=AD,Number=.,Type=Integer,Description="Allelic depths for the ref and alt alleles in the order listed">\n',
+            '##FORMAT=<ID=ADFL,Number=1,Type=String,Description="Number of flanking reads consistent with the allele">\n',
+            '##FORMAT=<ID=ADIR,Number=1,Type=String,Description="Number of in-repeat reads consistent with the allele">\n',
+            '##FORMAT=<ID=ADSP,Number=1,Type=String,Description="Number of spanning reads consistent with the allele">\n',
+            '##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n',
+            '##FORMAT=<ID=LC,Number=1,Type=Float,Description="Locus coverage">\n',
+            '##FORMAT=<ID=REPCI,Number=1,Type=String,Description="Confidence interval for REPCN">\n',
+            '##FORMAT=<ID=REPCN,Number=1,Type=String,Description="Number of repeat units spanned by the allele">\n',
+            '##FORMAT=<ID=SO,Number=1,Type=String,Description="Type of reads that support the allele; can be SPANNING, FLANKING, or INREPEAT meaning that the reads span, flank, or are fully contained in the repeat">\n',
+            '##ALT=<ID=STR10,Description="Allele comprised of 10 repeat units">\n',
+            '##ALT=<ID=STR2,Description="Allele comprised of 2 repeat units">\n',
+            '#{}\n'.format('\t'.join(headers)),
+        ]
+        for variant in variants:
+            cols = variant[:3] + [variant[4]]
+            ci = {}
+            for l, m, u in variant[5]:
+                ci[m] = (l, u)
+            #print(variant[5])
+            gt = Variant.get_genotype(variant)
+
+            for allele_size in self.get_allele_sizes(variant[4], gt):
+                cols.extend(allele_size)
+
+            chrom = cols[0]
+            start_pos = cols[1]
+            end_pos = cols[2]
+
+            ref_repeat_length = int(end_pos) - int(start_pos)
+            repeat_unit = cols[3]
+            ref_allele = repeat_unit[0]
+            ref_repeat_count = int(ref_repeat_length / len(repeat_unit))
+            repeat_id, variant_id = loci["{}:{}-{}".format(chrom, start_pos, end_pos)]
+
+            allele1_repeat_count = round(cols[5])
+            allel1_ci_lower, allel1_ci_upper = ci[cols[5]]
+            allel1_support = cols[6]
+
+            homzygous =  len(gt) == 1
+
+            if homzygous:
+                is_ref_allele = abs(allele1_repeat_count - ref_repeat_count) < 1
+                if is_ref_allele:
+                    # No variant here
+                    pass
+                else:
+                    rows.append(f"{chrom}\t{start_pos}\t.\t{ref_allele}\t<STR{allele1_repeat_count}>\t.\tPASS\t"
+                                f"SVTYPE=STR;END={end_pos};REF={ref_repeat_count};RL={ref_repeat_length};RU={repeat_unit};REPID={repeat_id};VARID={variant_id}\t"
+                                f"GT:SO:CN:CI:AD_SP:AD_FL:AD_IR\t"
+                                f"1/1:SPANNING/SPANNING:{allele1_repeat_count}/{allele1_repeat_count}:"
+                                f"{round(allel1_ci_lower)}-{round(allel1_ci_upper)}/{round(allel1_ci_lower)}-{round(allel1_ci_upper)}:"
+                                f"{allel1_support / 2}/{allel1_support / 2}:0/0:0/0\n")
 
-                if homzygous:
-                    is_ref_allele = abs(allele1_repeat_count - ref_repeat_count) < 1
-                    if is_ref_allele:
-                        # No variant here
-                        pass
-                    else:
-                        out.write("{}\t{}\t.\t{}\t<STR{}>\t.\tPASS\tSVTYPE=STR;END={};REF={};RL={};RU={};REPID={};VARID={}\tGT:SO:CN:CI:AD_SP:AD_FL:AD_IR\t1/1:SPANNING/SPANNING:{}/{}:{}-{}/{}-{}:{}/{}:0/0:0/0\n".format(chrom, start_pos, ref_allele, allele1_repeat_count, end_pos,  ref_repeat_count, ref_repeat_length, repeat_unit, repeat_id, variant_id, allele1_repeat_count, allele1_repeat_count, round(allel1_ci_lower), round(allel1_ci_upper), round(allel1_ci_lower), round(allel1_ci_upper), allel1_support / 2, allel1_support / 2))
+            else:
+                allele2_repeat_count = round(cols[8])
+                allel2_ci_lower, allel2_ci_upper = ci[cols[8]]
+                allel2_support = cols[9]
 
-                else:
-                    allele2_repeat_count = round(cols[8])
-                    allel2_ci_lower, allel2_ci_upper = ci[cols[8]]
-                    allel2_support = cols[9]
+                rows.append(f"{chrom}\t{start_pos}\t.\t{ref_allele}\t<STR{allele1_repeat_count}>,<STR{allele2_repeat_count}>\t.\tPASS\t"
+                            f"SVTYPE=STR;END={end_pos};REF={ref_repeat_count};RL={ref_repeat_length};RU={repeat_unit};REPID={repeat_id};VARID={variant_id}\t"
+                            f"GT:SO:CN:CI:AD_SP:AD_FL:AD_IR\t"
+                            f"1/2:SPANNING/SPANNING:{allele1_repeat_count}/{allele2_repeat_count}:"
+                            f"{round(allel1_ci_lower)}-{round(allel1_ci_upper)}/{round(allel2_ci_lower)}-{round(allel2_ci_upper)}:"
+                            f"{allel1_support}/{allel2_support}:0/0:0/0\n")
 
-                    out.write("{}\t{}\t.\t{}\t<STR{}>,<STR{}>\t.\tPASS\tSVTYPE=STR;END={};REF={};RL={};RU={};REPID={};VARID={}\tGT:SO:CN:CI:AD_SP:AD_FL:AD_IR\t1/2:SPANNING/SPANNING:{}/{}:{}-{}/{}-{}:{}/{}:0/0:0/0\n".format(chrom, start_pos, ref_allele, allele1_repeat_count, allele2_repeat_count, end_pos,  ref_repeat_count, ref_repeat_length, repeat_unit, repeat_id, variant_id, allele1_repeat_count, allele2_repeat_count, round(allel1_ci_lower), round(allel1_ci_upper), round(allel2_ci_lower), round(allel2_ci_upper), allel1_support, allel2_support))
+        with open(out_file, 'w') as out:
+            out.writelines(rows)
 
     def cleanup(self):
         if self.tmp_files:
             for ff in self.tmp_files:
-                if os.path.exists(ff):
+                try:
                     os.remove(ff)
+                except FileNotFoundError:
+                    pass
@@ -2,11 +2,21 @@ from pathos.multiprocessing import ProcessingPool as Pool
 import tempfile
 import sys
 import os
+import re
+import random
 from operator import itemgetter
+from functools import lru_cache
 
-def split_tasks(args, n):
+def split_tasks(args, n, shuffle=False):
+    """Splits args into at most n batches, optionally in random order without reordering args itself"""
     k, m = divmod(len(args), n)
-    batches = (args[i * k + min(i, m):(i + 1) * k + min(i + 1, m)] for i in range(n))
+    spans = [(i * k + min(i, m), (i + 1) * k + min(i + 1, m)) for i in range(n)]
+    if shuffle:
+        order = list(range(len(args)))
+        random.shuffle(order)
+        batches = ([args[j] for j in order[start:end]] for start, end in spans)
+    else:
+        batches = (args[start:end] for start, end in spans)
     return [b for b in batches if b]
 
 def parallel_process(func, args, nprocs, bam=None, fasta=None):
@@ -36,10 +46,14 @@ def combine_batch_results(batch_results, data_type):
     return all_results
 
 def create_tmp_file(content):
+    """content can be a string or a list of strings to be written in order"""
     fd, path = tempfile.mkstemp()
     try:
         with os.fdopen(fd, 'w') as out:
-            out.write(content)
+            if isinstance(content, str):
+                out.write(content)
+            else:
+                out.writelines(content)
     except:
         sys.exit("can't generate temp file: {}".format(path))
 
@@ -50,6 +64,33 @@ def reverse_complement(seq):
     complement = str.maketrans("agtcAGTC", "tcagTCAG")
     return seq[::-1].translate(complement)
 
+@lru_cache(maxsize=4096)
+def rotations(rep):
+    """Distinct rotations of a motif, starting with the motif itself"""
+    return tuple(dict.fromkeys(rep[i:] + rep[:i] for i in range(len(rep))))
+
+def covered_fraction(seq, pat):
+    """Fraction of seq covered by non-overlapping copies of pat"""
+    n = seq.count(pat)
+    return float(n * len(pat)) / len(seq) if n else 0.0
+
+def rotation_covers(rep1, rep2, min_fraction):
+    """Checks if any rotation of rep1 covers at least min_fraction of rep2"""
+    if len(rep1) == len(rep2):
+        # rep2 is either a rotation of rep1 (fully covered) or not covered at all
+        return min_fraction <= 1 and rep2 in rep1 + rep1
+
+    for pat in rotations(rep1):
+        fraction = covered_fraction(rep2, pat)
+        if fraction and fraction >= min_fraction:
+            return True
+    return False
+
+@lru_cache(maxsize=1024)
+def motif_regex(repeat):
+    """Compiled regex for a motif, '*' matching any base"""
+    return re.compile(repeat.upper().replace('*', '[AGCT]'))
+
 def merge_spans(spans):
     spans_checked = [span for span in spans if len(span) == 2 and type(span[0]) is int and type(span[1]) is int and span[0]<=span[1]]
     spans_sorted = sorted(spans_checked, key=itemgetter(0,1))